@@ -300,4 +300,450 @@ class BTree:
         else:
             print("The key doesn't exist in the tree.")
 
+    def levels(self) -> List[List[BTreeNode]]:
+        """
+        Read the whole tree breadth first.
+        Returns one list of nodes per level, root first, each ordered left to right.
+        """
+        levels = [[DISK.read(self.root_addr)]]
+        while not levels[-1][0].is_leaf:
+            levels.append([node.get_child(i) for node in levels[-1] for i in range(len(node.children_addrs))])
+        return levels
+
+    def fragmentation(self) -> float:
+        """
+        Fraction of neighbouring leaves (in key order) that are not stored in
+        consecutive disk blocks. 0.0 means a scan over the leaves is fully
+        sequential, values close to 1.0 mean nearly every step is a seek.
+        Every internal node is read once, plus the leftmost leaf to find the bottom level.
+        """
+        parents = [DISK.read(self.root_addr)]
+        if parents[0].is_leaf:
+            return 0.0
+        while True:
+            first = parents[0].get_child(0)
+            if first.is_leaf:
+                break
+            parents = [first] + [parent.get_child(i) for j, parent in enumerate(parents)
+                                 for i in range(len(parent.children_addrs)) if (j, i) != (0, 0)]
+        leaf_addrs = [addr for parent in parents for addr in parent.children_addrs]
+        jumps = sum(1 for a, b in zip(leaf_addrs, leaf_addrs[1:]) if b != a + 1)
+        return jumps / (len(leaf_addrs) - 1)
+
+    def recluster(self) -> None:
+        """
+        Lay the tree's pages out in one run of consecutive blocks, one level
+        after the other, root first, with the leaves in ascending key order.
+
+        If the tree's blocks already form a single run the pages are permuted
+        within it. Otherwise they are freed and the tree is written to the
+        lowest free run that fits, which may include its own old blocks,
+        and the disk only grows when there is no such run.
+
+        Blocks the tree gives up stay on DISK's free list, and new() hands out
+        the most recently freed block first, so splits right after a
+        recluster may land away from the run and fragment the leaves again.
+
+        This is an offline operation: the tree is read into memory and must
+        not be modified while it runs.
+        """
+        levels = self.levels()
+        old_addrs = [node.my_addr for level in levels for node in level]
+        start = min(old_addrs)
+        if max(old_addrs) - start + 1 != len(old_addrs):
+            for addr in old_addrs:
+                DISK.free(addr)
+            start = DISK.new_run(len(old_addrs))
+        new_addrs = {addr: start + idx for idx, addr in enumerate(old_addrs)}
+
+        for depth, level in enumerate(levels):
+            children = iter(levels[depth + 1]) if depth + 1 < len(levels) else iter([])
+            for node in level:
+                node.my_addr = new_addrs[node.my_addr]
+                node.children_addrs = [new_addrs[addr] for addr in node.children_addrs]
+                for idx in range(len(node.children_addrs)):
+                    child = next(children)
+                    child.parent_addr = node.my_addr
+                    child.index_in_parent = idx
+
+        root = levels[0][0]
+        root.parent_addr = None
+        root.index_in_parent = None
+        self.root_addr = root.my_addr
+        for level in levels:
+            for node in level:
+                node.write_back()
 
+    @classmethod
+    def from_root(cls, M: int, L: int, root_addr: Address) -> "BTree":
+        """
+        Wrap a subtree that already lives on disk in a BTree, without allocating a new root.
+        """
+        tree = cls.__new__(cls)
+        tree.root_addr = root_addr
+        tree.M = M
+        tree.L = L
+        return tree
+
+    def node_size(self, node: BTreeNode) -> int:
+        return len(node.keys) if node.is_leaf else len(node.children_addrs)
+
+    def min_size(self, node: BTreeNode) -> int:
+        return (self.L + 1) // 2 if node.is_leaf else (self.M + 1) // 2
+
+    def max_size(self, node: BTreeNode) -> int:
+        return self.L if node.is_leaf else self.M
+
+    def adopt(self, node: BTreeNode, start: int = 0) -> None:
+        """
+        Point node's children from position `start` onwards back at node,
+        after they were moved into it or shifted inside it.
+        """
+        for idx in range(start, len(node.children_addrs)):
+            child = node.get_child(idx)
+            child.parent_addr = node.my_addr
+            child.index_in_parent = idx
+            child.write_back()
+
+    def distribute(self, node: BTreeNode, node1: BTreeNode, keys: List[KT], data: List[VT], children: List[Address]) -> KT:
+        """
+        Spread the combined contents of two neighbouring nodes evenly, the
+        smaller half going to the left node. Returns the new separator key.
+        """
+        half = (len(keys) if node.is_leaf else len(children)) // 2
+        if node.is_leaf:
+            node.keys, node1.keys = keys[:half], keys[half:]
+            node.data, node1.data = data[:half], data[half:]
+            split_key = node1.keys[0]
+        else:
+            node.children_addrs, node1.children_addrs = children[:half], children[half:]
+            node.keys, split_key, node1.keys = keys[:half - 1], keys[half - 1], keys[half:]
+        node.write_back()
+        node1.write_back()
+        if not node.is_leaf:
+            self.adopt(node)
+            self.adopt(node1)
+        return split_key
+
+    def rebalance_pair(self, node: BTreeNode, split_key: KT, node1: BTreeNode) -> Optional[KT]:
+        """
+        Even out two neighbouring nodes separated by split_key in their parent.
+        If everything fits in one node it is merged into `node`, node1's block
+        is freed and None is returned; otherwise returns the new separator.
+        """
+        keys = node.keys + ([] if node.is_leaf else [split_key]) + node1.keys
+        data = node.data + node1.data
+        children = node.children_addrs + node1.children_addrs
+        if (len(keys) if node.is_leaf else len(children)) > self.max_size(node):
+            return self.distribute(node, node1, keys, data, children)
+        node.keys, node.data, node.children_addrs = keys, data, children
+        node.write_back()
+        DISK.free(node1.my_addr)
+        if not node.is_leaf:
+            self.adopt(node)
+        return None
+
+    def split_up(self, node: BTreeNode) -> bool:
+        """
+        Split `node` and its ancestors for as long as they overflow.
+        Returns True if the root was split and the tree grew a level.
+        """
+        grew = False
+        while self.node_size(node) > self.max_size(node):
+            node1 = BTreeNode(DISK.new(), node.parent_addr, None, node.is_leaf)
+            split_key = self.distribute(node, node1, node.keys, node.data, node.children_addrs)
+            if node.parent_addr is None:
+                parent = BTreeNode(DISK.new(), None, None, False)
+                parent.children_addrs = [node.my_addr]
+                self.root_addr = parent.my_addr
+                grew = True
+            else:
+                parent = DISK.read(node.parent_addr)
+            idx = parent.children_addrs.index(node.my_addr)
+            parent.keys.insert(idx, split_key)
+            parent.children_addrs.insert(idx + 1, node1.my_addr)
+            parent.write_back()
+            self.adopt(parent, idx)
+            node = parent
+        return grew
+
+    def collapse_root(self, height: int) -> int:
+        """
+        Drop internal roots that are left with a single child.
+        Returns the height of the tree afterwards.
+        """
+        root = DISK.read(self.root_addr)
+        while not root.is_leaf and len(root.children_addrs) == 1:
+            DISK.free(root.my_addr)
+            root = root.get_child(0)
+            root.parent_addr = None
+            root.index_in_parent = None
+            root.write_back()
+            self.root_addr = root.my_addr
+            height -= 1
+        return height
+
+    def spine(self, rightmost: bool) -> Tuple[int, BTreeNode]:
+        """
+        Walk down the leftmost (or rightmost) path.
+        Returns the height of the tree, where a lone leaf has height 0, and the leaf reached.
+        """
+        node = DISK.read(self.root_addr)
+        height = 0
+        while not node.is_leaf:
+            node = node.get_child(-1 if rightmost else 0)
+            height += 1
+        return height, node
+
+    def graft(self, height: int, sub_addr: Address, sub_height: int, split_key: KT, on_right: bool) -> int:
+        """
+        Hang the subtree rooted at sub_addr, whose height is at most this
+        tree's, off the right (or left) spine of this tree at the level where
+        its root fits, separated from its new neighbour by split_key.
+        Only the nodes along one spine are touched. Returns the new height.
+        """
+        parent = DISK.read(self.root_addr)
+        new_root = height == sub_height
+        if new_root:
+            root = BTreeNode(DISK.new(), None, None, False)
+            root.children_addrs = [self.root_addr]
+            self.root_addr = root.my_addr
+            parent = root
+            height += 1
+        else:
+            for _ in range(height - sub_height - 1):
+                parent = parent.get_child(-1 if on_right else 0)
+        if on_right:
+            parent.keys.append(split_key)
+            parent.children_addrs.append(sub_addr)
+        else:
+            parent.keys.insert(0, split_key)
+            parent.children_addrs.insert(0, sub_addr)
+        parent.write_back()
+        self.adopt(parent, len(parent.children_addrs) - 1 if on_right and not new_root else 0)
+
+        # The grafted subtree's root may be smaller than a regular node, as may
+        # an old root that just got a new parent, so even them out
+        idx = len(parent.children_addrs) - 2 if on_right else 0
+        node, node1 = parent.get_child(idx), parent.get_child(idx + 1)
+        if self.node_size(node) < self.min_size(node) or self.node_size(node1) < self.min_size(node1):
+            new_key = self.rebalance_pair(node, parent.keys[idx], node1)
+            if new_key is None:
+                del parent.keys[idx]
+                del parent.children_addrs[idx + 1]
+                self.adopt(parent, idx + 1)
+            else:
+                parent.keys[idx] = new_key
+            parent.write_back()
+
+        if self.split_up(parent):
+            height += 1
+        return self.collapse_root(height)
+
+    @staticmethod
+    def concat(left: Tuple["BTree", int], right: Tuple["BTree", int], split_key: KT) -> Tuple["BTree", int]:
+        """
+        Join two (tree, height) pairs whose keys are separated by split_key,
+        grafting the shorter tree into the taller one.
+        """
+        (left_tree, left_height), (right_tree, right_height) = left, right
+        if left_height >= right_height:
+            return left_tree, left_tree.graft(left_height, right_tree.root_addr, right_height, split_key, True)
+        return right_tree, right_tree.graft(right_height, left_tree.root_addr, left_height, split_key, False)
+
+    @staticmethod
+    def join(left: "BTree", right: "BTree") -> "BTree":
+        """
+        Concatenate two trees with the same M and L, where every key of `left`
+        is smaller than every key of `right`. The shorter tree's root is hung
+        off the taller tree's spine, so the cost is proportional to the
+        height, and no leaf is copied.
+
+        Returns `left`, which now holds every key. `right` must not be used afterwards.
+        """
+        if left.M != right.M or left.L != right.L:
+            raise ValueError("Only trees with the same M and L can be joined.")
+        left_height, last_leaf = left.spine(True)
+        right_height, first_leaf = right.spine(False)
+        if not first_leaf.keys:
+            DISK.free(right.root_addr)
+            return left
+        if not last_leaf.keys:
+            DISK.free(left.root_addr)
+            left.root_addr = right.root_addr
+            return left
+        if last_leaf.keys[-1] >= first_leaf.keys[0]:
+            raise ValueError("Every key of the left tree must be smaller than every key of the right tree.")
+        tree, _ = BTree.concat((left, left_height), (right, right_height), first_leaf.keys[0])
+        left.root_addr = tree.root_addr
+        return left
+
+    def piece(self, node: BTreeNode, keys: List[KT], data: List[VT], children: List[Address], height: int, reuse: bool) -> Optional[Tuple["BTree", int]]:
+        """
+        Turn part of a node cut by split_at into the root of a standalone
+        subtree, reusing the node's own block or a fresh one.
+        Returns the subtree and its height, or None if the part is empty.
+        """
+        if not (keys if node.is_leaf else children):
+            if reuse:
+                DISK.free(node.my_addr)
+            return None
+        root = node if reuse else BTreeNode(DISK.new(), None, None, node.is_leaf)
+        root.keys, root.data, root.children_addrs = keys, data, children
+        root.parent_addr = None
+        root.index_in_parent = None
+        root.write_back()
+        if not reuse and not root.is_leaf:
+            self.adopt(root)
+        tree = BTree.from_root(self.M, self.L, root.my_addr)
+        return tree, tree.collapse_root(height)
+
+    def split_at(self, key: KT) -> Tuple["BTree", "BTree"]:
+        """
+        Cut the tree in two along the path to `key`. Keys smaller than `key`
+        stay in this tree, the others move to a new tree. The subtrees hanging
+        left and right of the path are reassembled with concat, so the cost is
+        proportional to the height and no leaf off the path is copied.
+
+        Returns (self, new tree).
+        """
+        height, _ = self.spine(False)
+        left: Optional[Tuple[BTree, int]] = None
+        right: Optional[Tuple[BTree, int]] = None
+        left_key = right_key = None  # Separators bounding the current node from the pieces gathered so far
+        node = DISK.read(self.root_addr)
+        while True:
+            keys = node.keys
+            if node.is_leaf:
+                idx = node.find_idx(key)
+                left_part = (keys[:idx], node.data[:idx], [])
+                right_part = (keys[idx:], node.data[idx:], [])
+            else:
+                idx = bisect.bisect_right(keys, key)
+                child_addr = node.children_addrs[idx]
+                left_part = (keys[:max(idx - 1, 0)], [], node.children_addrs[:idx])
+                right_part = (keys[idx + 1:], [], node.children_addrs[idx + 1:])
+
+            right_piece = self.piece(node, *right_part, height, reuse=False)
+            left_piece = self.piece(node, *left_part, height, reuse=True)
+            if left_piece is not None:
+                left = left_piece if left is None else BTree.concat(left, left_piece, left_key)
+            if right_piece is not None:
+                right = right_piece if right is None else BTree.concat(right_piece, right, right_key)
+
+            if node.is_leaf:
+                break
+            if idx > 0:
+                left_key = keys[idx - 1]
+            if idx < len(keys):
+                right_key = keys[idx]
+            node = DISK.read(child_addr)
+            height -= 1
+
+        if left is None:
+            left = BTree(self.M, self.L), 0
+        self.root_addr = left[0].root_addr
+        return self, right[0] if right is not None else BTree(self.M, self.L)
+
+    def free_subtree(self, addr: Address, height: int) -> None:
+        """
+        Free every block of the subtree rooted at addr.
+        Only internal nodes are read; leaves are released straight from their parent's children_addrs.
+        """
+        if height > 0:
+            node = DISK.read(addr)
+            for child_addr in node.children_addrs:
+                self.free_subtree(child_addr, height - 1)
+        DISK.free(addr)
+
+    def clear(self) -> None:
+        """
+        Remove every key, freeing all blocks but the root's, which becomes an empty leaf.
+        """
+        height, _ = self.spine(False)
+        if height > 0:
+            for child_addr in DISK.read(self.root_addr).children_addrs:
+                self.free_subtree(child_addr, height - 1)
+        DISK.write(self.root_addr, BTreeNode(self.root_addr, None, None, True))
+
+    def find_leaf_bounded(self, key: KT) -> Tuple[BTreeNode, Optional[KT]]:
+        """
+        Like find_leaf, but also returns the separator that bounds the leaf on
+        the right, i.e. the smallest key the next leaf may hold, or None for
+        the last leaf.
+        """
+        current_node = DISK.read(self.root_addr)
+        upper = None
+        while not current_node.is_leaf:
+            idx = bisect.bisect_right(current_node.keys, key)
+            if idx < len(current_node.keys):
+                upper = current_node.keys[idx]
+            current_node = current_node.get_child(idx)
+        return current_node, upper
+
+    def fix_underflow(self, node: BTreeNode) -> None:
+        """
+        Borrow from or merge with a sibling while `node` is below its minimum
+        size, walking up one path. Drops the root if it ends up with a single child.
+        """
+        while node.parent_addr is not None and self.node_size(node) < self.min_size(node):
+            parent = DISK.read(node.parent_addr)
+            idx = parent.children_addrs.index(node.my_addr)
+            if idx > 0:
+                key_idx, node, node1 = idx - 1, parent.get_child(idx - 1), node
+            else:
+                key_idx, node1 = 0, parent.get_child(1)
+            new_key = self.rebalance_pair(node, parent.keys[key_idx], node1)
+            if new_key is None:
+                del parent.keys[key_idx]
+                del parent.children_addrs[key_idx + 1]
+                parent.write_back()
+                self.adopt(parent, key_idx + 1)
+            else:
+                parent.keys[key_idx] = new_key
+                parent.write_back()
+            node = parent
+        self.collapse_root(0)
+
+    def delete_range(self, lo: KT, hi: KT) -> None:
+        """
+        Delete every key k with lo <= k < hi.
+
+        When the range lies within one leaf, or within two neighbouring
+        leaves, those leaves are trimmed in place and rebalanced once along
+        their paths. Otherwise the tree is cut at lo and at hi with split_at,
+        the middle part is freed as a whole and the outer parts are joined
+        back together. Either way the block I/O is proportional to the height
+        plus the number of freed blocks rather than to the number of deleted keys.
+        """
+        if not lo < hi:
+            return
+        # With M == 2 a node can be an only child, with no sibling to rebalance
+        # with, so always cut. Otherwise cut only when whole leaves are covered.
+        covered = self.M == 2
+        if not covered:
+            leaves = [self.find_leaf_bounded(lo)]
+            if leaves[0][1] is not None and hi > leaves[0][1]:
+                leaves.append(self.find_leaf_bounded(leaves[0][1]))
+                covered = leaves[1][1] is not None and hi > leaves[1][1]
+        if covered:
+            _, rest = self.split_at(lo)
+            middle, right = rest.split_at(hi)
+            height, _ = middle.spine(False)
+            middle.free_subtree(middle.root_addr, height)
+            BTree.join(self, right)
+            return
+
+        for leaf, _ in leaves:
+            start, end = leaf.find_idx(lo), leaf.find_idx(hi)
+            del leaf.keys[start:end]
+            del leaf.data[start:end]
+            leaf.write_back()
+        leaf = leaves[0][0]
+        if leaf.parent_addr is not None and self.node_size(leaf) < self.min_size(leaf):
+            self.fix_underflow(leaf)
+            if len(leaves) == 2:
+                # The second leaf may have lent keys or been merged away
+                leaves[1] = (self.find_leaf(leaves[0][1]), None)
+        if len(leaves) == 2:
+            self.fix_underflow(leaves[1][0])
@@ -2,8 +2,12 @@
 Disk interface abstraction for the B-Tree
 """
 
+import bz2
+import lzma
 import pickle
-from typing import List, NewType
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, List, NewType, Optional, Set, Tuple
 
 #NUM_BLOCKS = 20
 #BLOCK_SIZE = 4096
@@ -11,11 +15,31 @@ LOGGING = False
 
 Address = NewType("Address", int)  # Address type
 
+# Page codecs: name -> (header id, compress(raw, level), decompress(payload)).
+# Every block starts with a one byte header holding the id of the codec that
+# produced the rest of the block, so pages written under different settings
+# can live side by side on the same disk.
+CODECS: Dict[str, Tuple[int, Callable[[bytes, int], bytes], Callable[[bytes], bytes]]] = {
+    "none": (0, lambda raw, level: raw, lambda payload: payload),
+    "zlib": (1, lambda raw, level: zlib.compress(raw, level), zlib.decompress),
+    "bz2": (2, lambda raw, level: bz2.compress(raw, level), bz2.decompress),
+    "lzma": (3, lambda raw, level: lzma.compress(raw, preset=level), lzma.decompress),
+}
+DEFAULT_LEVELS = {"none": 0, "zlib": 6, "bz2": 9, "lzma": 6}
+LEVEL_RANGES = {"zlib": (-1, 9), "bz2": (1, 9), "lzma": (0, 9)}  # Inclusive, as accepted by each module
+_DECOMPRESSORS = {codec_id: decompress for codec_id, _, decompress in CODECS.values()}
+
 class Disk:
     __frozen = False
 
     def __init__(self):
         self.memory: List[bytearray] = []
+        # Compression settings; see set_compression. Mutated in place since the disk is frozen.
+        self.config = {"codec": "none", "level": 0, "threshold": 0, "cache_pages": 64}
+        # Buffer pool of decompressed pages, so hot compressed pages are only inflated once.
+        self.cache: "OrderedDict[Address, bytes]" = OrderedDict()
+        self.free_blocks: List[Address] = []  # Released blocks, handed out again by new
+        self.free_set: Set[Address] = set()  # Same blocks, for constant time membership checks
         self.__frozen = True
 
     def __setattr__(self, name: str, value) -> None:
@@ -26,19 +50,127 @@ class Disk:
     def verify(self):
         assert self == DISK, "Error. Did you override DISK?"
 
+    def set_compression(self, name: str = "none", level: Optional[int] = None, threshold: int = 0, cache_pages: int = 64):
+        """
+        Choose the codec used for pages written from now on.
+
+        * name is one of the keys of CODECS ("none", "zlib", "bz2", "lzma").
+        * level is passed to the codec, higher is smaller but slower. zlib
+          accepts -1 to 9, bz2 1 to 9 and lzma 0 to 9; "none" ignores it.
+          Defaults to the codec's usual level.
+        * Pages whose pickle is shorter than threshold bytes are stored
+          uncompressed, since small pages gain little and still cost CPU.
+        * cache_pages bounds the buffer pool of decompressed pages.
+
+        Pages already on disk keep the codec recorded in their header.
+        """
+        if name not in CODECS:
+            raise ValueError(f"Unknown codec {name!r}. Choose one of {sorted(CODECS)}.")
+        if level is None:
+            level = DEFAULT_LEVELS[name]
+        if name in LEVEL_RANGES:
+            low, high = LEVEL_RANGES[name]
+            if not low <= level <= high:
+                raise ValueError(f"Level {level} is out of range for {name}. Choose one between {low} and {high}.")
+        self.config.update(codec=name, level=level, threshold=threshold, cache_pages=cache_pages)
+        self.cache.clear()
+
+    def encode(self, raw: bytes) -> bytearray:
+        """Prefix the pickled page with its codec header, compressing it if worthwhile."""
+        name = self.config["codec"]
+        if len(raw) < self.config["threshold"]:
+            name = "none"
+        codec_id, compress, _ = CODECS[name]
+        payload = compress(raw, self.config["level"])
+        if len(payload) >= len(raw):
+            codec_id, payload = CODECS["none"][0], raw
+        return bytearray(bytes([codec_id]) + payload)
+
+    def decode(self, addr: Address) -> bytes:
+        """Return the raw pickle stored at addr, going through the buffer pool for compressed pages."""
+        block = self.memory[addr]
+        codec_id = block[0]
+        if codec_id == CODECS["none"][0]:
+            return bytes(block[1:])
+        if addr in self.cache:
+            self.cache.move_to_end(addr)
+            return self.cache[addr]
+        raw = _DECOMPRESSORS[codec_id](bytes(block[1:]))
+        if self.config["cache_pages"] > 0:
+            self.cache[addr] = raw
+            if len(self.cache) > self.config["cache_pages"]:
+                self.cache.popitem(last=False)
+        return raw
+
+    def size(self) -> int:
+        """Total number of bytes stored on the disk, headers included."""
+        return sum(len(block) for block in self.memory)
+
     def new(self) -> Address:
         self.verify()
-        empty = bytearray(pickle.dumps(object()))
-        self.memory.append(empty)
+        empty = self.encode(pickle.dumps(object()))
+        if self.free_blocks:
+            addr = self.free_blocks.pop()
+            self.free_set.remove(addr)
+            self.memory[addr] = empty
+        else:
+            self.memory.append(empty)
+            addr = len(self.memory) - 1
         if LOGGING:
-            print(f"allocated block {len(self.memory) - 1}")
-        return len(self.memory) - 1
+            print(f"allocated block {addr}")
+        return addr
+
+    def new_run(self, count: int) -> Address:
+        """
+        Allocate `count` consecutive blocks. The lowest run of free blocks
+        that is long enough is used; only if there is none are the blocks
+        appended to the end of the disk. Returns the address of the first one.
+        """
+        self.verify()
+        start, length = None, 0
+        for addr in sorted(self.free_set):
+            if length and addr == start + length:
+                length += 1
+            else:
+                start, length = addr, 1
+            if length == count:
+                break
+        if count and length == count:
+            run = set(range(start, start + count))
+            self.free_set.difference_update(run)
+            self.free_blocks[:] = [addr for addr in self.free_blocks if addr not in run]
+            for addr in run:
+                self.memory[addr] = self.encode(pickle.dumps(object()))
+        else:
+            start = len(self.memory)
+            for _ in range(count):
+                self.memory.append(self.encode(pickle.dumps(object())))
+        if LOGGING:
+            print(f"allocated blocks {start} to {start + count - 1}")
+        return start
+
+    def free(self, addr: Address):
+        """
+        Release a block so that a later call to new can hand it out again.
+        The block must no longer be referenced by any node.
+        """
+        self.verify()
+        if addr >= len(self.memory):
+            raise ValueError(f"Error: Memory address {addr} has not yet been allocated. You cannot free it.")
+        if addr in self.free_set:
+            raise ValueError(f"Error: Memory address {addr} has already been freed. You cannot free it twice.")
+        self.cache.pop(addr, None)
+        self.memory[addr] = self.encode(pickle.dumps(object()))
+        self.free_blocks.append(addr)
+        self.free_set.add(addr)
+        if LOGGING:
+            print(f"freed block {addr}")
 
     def read(self, addr: Address) -> "BTreeNode":
         self.verify()
         if addr >= len(self.memory):
             raise ValueError(f"Error: Memory address {addr} has not yet been allocated. You cannot read from it.")
-        block = self.memory[addr]
+        block = self.decode(addr)
         if LOGGING:
             print(f"read {pickle.loads(block)} at block {addr}")
         return pickle.loads(block)
@@ -54,8 +186,9 @@ class Disk:
             #raise Exception(f"Data blob of size {len(block)} cannot fit in the block size of {BLOCK_SIZE}")
         if LOGGING:
             print(f"wrote {data} to block {addr}")
-        self.memory[addr] = bytearray(block)
+        self.cache.pop(addr, None)
+        self.memory[addr] = self.encode(block)
 
 DISK = Disk()
 
-__all__ = ["DISK", "LOGGING"]
+__all__ = ["DISK", "LOGGING", "CODECS"]
@@ -2,6 +2,8 @@ from py_btrees.disk import DISK
 from py_btrees.btree import BTree
 from py_btrees.btree_node import BTreeNode, get_node
 
+import pickle
+import random
 import pytest
 from typing import Any
 
@@ -210,4 +212,260 @@ def test_delete():
 
     btree.delete(1)
     assert len(root.keys) == 1
-    assert root.is_leaf
\ No newline at end of file
+    assert root.is_leaf
+
+@pytest.mark.parametrize("codec", ["zlib", "bz2", "lzma"])
+def test_compressed_pages(codec):
+    size = DISK.size()
+    BTree(50, 50).insert(0, "feature-value-" * 320)
+    raw_growth = DISK.size() - size
+    DISK.set_compression(codec, threshold=0)
+    try:
+        size = DISK.size()
+        BTree(50, 50).insert(0, "feature-value-" * 320)
+        assert DISK.size() - size < raw_growth / 4 # the same page takes far less space on disk
+
+        btree = BTree(50, 50)
+        for i in range(40):
+            btree.insert(i, "feature-value-" * 8)
+        leaf = DISK.memory[btree.root_addr]
+        assert leaf[0] != 0 # the header records a real codec
+        assert len(leaf) < len(pickle.dumps(DISK.read(btree.root_addr)))
+        assert btree.find(7) == "feature-value-" * 8
+        assert btree.root_addr in DISK.cache # decompressed once, then served from the buffer pool
+        assert btree.find(8) == "feature-value-" * 8
+    finally:
+        DISK.set_compression("none")
+
+def test_compression_threshold():
+    DISK.set_compression("zlib", level=9, threshold=10 ** 6)
+    try:
+        btree = BTree(50, 50)
+        btree.insert(1, "One" * 100)
+        assert DISK.memory[btree.root_addr][0] == 0 # below the threshold, stored raw
+        assert btree.find(1) == "One" * 100
+    finally:
+        DISK.set_compression("none")
+    # Pages written under the old settings remain readable
+    assert btree.find(1) == "One" * 100
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        DISK.set_compression("snappy")
+
+@pytest.mark.parametrize("codec,level", [("zlib", 10), ("zlib", -2), ("bz2", 0), ("lzma", 10)])
+def test_invalid_compression_level(codec, level):
+    with pytest.raises(ValueError):
+        DISK.set_compression(codec, level=level)
+    btree = BTree(4, 2) # the disk is still usable
+    btree.insert(1, "One")
+    assert btree.find(1) == "One"
+
+def chunk(items, size):
+    # Split items into ceil(len / size) runs of near equal length
+    count = max(1, -(-len(items) // size))
+    return [items[i * len(items) // count:(i + 1) * len(items) // count] for i in range(count)]
+
+def build_tree(M, L, keys, seed=None):
+    # Lay a valid tree out on DISK bottom up, optionally in shuffled block order,
+    # so the tests below do not depend on insert()
+    btree = BTree(M, L)
+    runs = chunk(sorted(keys), L)
+    levels = [[BTreeNode(None, None, None, True) for _ in runs]]
+    mins = [[run[0] for run in runs]] if runs[0] else [[None]]
+    for leaf, run in zip(levels[0], runs):
+        leaf.keys = list(run)
+        leaf.data = [str(k) for k in run]
+    while len(levels[-1]) > 1:
+        groups = chunk(list(range(len(levels[-1]))), M)
+        levels.append([BTreeNode(None, None, None, False) for _ in groups])
+        mins.append([mins[-1][group[0]] for group in groups])
+    nodes = [node for level in levels for node in level]
+    addrs = [btree.root_addr] + [DISK.new() for _ in nodes[1:]]
+    if seed is not None:
+        random.Random(seed).shuffle(addrs)
+    for node, addr in zip(nodes, addrs):
+        node.my_addr = addr
+    for depth in range(1, len(levels)):
+        lower = levels[depth - 1]
+        for parent, group in zip(levels[depth], chunk(list(range(len(lower))), M)):
+            parent.children_addrs = [lower[i].my_addr for i in group]
+            parent.keys = [mins[depth - 1][i] for i in group[1:]]
+            for idx, i in enumerate(group):
+                lower[i].parent_addr = parent.my_addr
+                lower[i].index_in_parent = idx
+    for node in nodes:
+        node.write_back()
+    btree.root_addr = levels[-1][0].my_addr
+    return btree
+
+def test_recluster():
+    M = 4
+    L = 3
+    btree = build_tree(M, L, range(200), seed=1)
+    assert btree.fragmentation() > 0.5
+    btree.recluster()
+    assert btree.fragmentation() == 0.0
+
+    levels = btree.levels()
+    addrs = [node.my_addr for level in levels for node in level]
+    assert addrs == sorted(addrs) # root first, every level contiguous, leaves in key order
+    assert [k for leaf in levels[-1] for k in leaf.keys] == list(range(200))
+    btree_properties_recurse(btree.root_addr, DISK.read(btree.root_addr), M, L)
+    for i in range(200):
+        assert btree.find(i) == str(i)
+
+def test_recluster_after_block_reuse():
+    M = 4
+    L = 3
+    btree = build_tree(M, L, range(300), seed=7)
+    btree.delete_range(100, 200)
+    other = build_tree(M, L, range(100), seed=8) # picks up the freed blocks
+    BTree.join(btree, build_tree(M, L, range(1000, 1200), seed=9))
+    keys = list(range(100)) + list(range(200, 300)) + list(range(1000, 1200))
+    btree.recluster()
+    assert btree.fragmentation() == 0.0
+    addrs = [node.my_addr for level in btree.levels() for node in level]
+    assert addrs == list(range(addrs[0], addrs[0] + len(addrs)))
+    check_tree(btree, keys)
+    check_tree(other, range(100))
+
+def test_recluster_reuses_blocks():
+    btree = build_tree(4, 3, range(300), seed=11)
+    btree.delete_range(100, 200)
+    pages = sum(len(level) for level in btree.levels())
+    blocks = len(DISK.memory)
+    btree.recluster()
+    assert len(DISK.memory) <= blocks + pages
+    blocks = len(DISK.memory)
+    for _ in range(5):
+        btree.recluster() # already one run, permuted in place
+    assert len(DISK.memory) == blocks
+    assert btree.fragmentation() == 0.0
+    check_tree(btree, list(range(100)) + list(range(200, 300)))
+
+def test_new_run_uses_free_blocks():
+    start = DISK.new_run(6)
+    for addr in range(start, start + 6):
+        DISK.free(addr)
+    blocks = len(DISK.memory)
+    run = DISK.new_run(4)
+    assert len(DISK.memory) == blocks # taken from the free blocks, not appended
+    assert DISK.free_set.isdisjoint(range(run, run + 4))
+    assert not set(range(run, run + 4)) & set(DISK.free_blocks)
+
+def test_recluster_single_leaf():
+    btree = BTree(4, 2)
+    btree.insert(1, "One")
+    btree.recluster()
+    assert btree.fragmentation() == 0.0
+    assert btree.find(1) == "One"
+
+def check_tree(btree, keys):
+    # Full structural check: handout properties, parent links, leaves on one level, contents
+    root = DISK.read(btree.root_addr)
+    btree_properties_recurse(btree.root_addr, root, btree.M, btree.L)
+    level = [root]
+    while not level[0].is_leaf:
+        children = []
+        for node in level:
+            assert not node.is_leaf
+            for idx, child_addr in enumerate(node.children_addrs):
+                child = DISK.read(child_addr)
+                assert child.my_addr == child_addr
+                assert child.parent_addr == node.my_addr
+                assert child.index_in_parent == idx
+                children.append(child)
+        level = children
+    assert all(node.is_leaf for node in level)
+    assert [k for leaf in level for k in leaf.keys] == sorted(keys)
+    for k in keys:
+        assert btree.find(k) == str(k)
+
+@pytest.mark.parametrize("M,L", [(3, 3), (4, 2), (5, 3), (6, 6)])
+@pytest.mark.parametrize("sizes", [(1, 1), (1, 200), (200, 1), (50, 60), (7, 300), (300, 7)])
+def test_join(M, L, sizes):
+    left_keys = list(range(sizes[0]))
+    right_keys = list(range(1000, 1000 + sizes[1]))
+    left = build_tree(M, L, left_keys, seed=2)
+    right = build_tree(M, L, right_keys, seed=3)
+    joined = BTree.join(left, right)
+    assert joined is left
+    check_tree(joined, left_keys + right_keys)
+
+def test_join_empty_and_overlapping():
+    left = build_tree(4, 3, range(10))
+    BTree.join(left, BTree(4, 3))
+    check_tree(left, range(10))
+    empty = BTree(4, 3)
+    BTree.join(empty, build_tree(4, 3, range(20, 30)))
+    check_tree(empty, range(20, 30))
+    with pytest.raises(ValueError):
+        BTree.join(build_tree(4, 3, range(10)), build_tree(4, 3, range(5, 15)))
+
+@pytest.mark.parametrize("M,L", [(3, 3), (4, 2), (5, 3), (6, 6)])
+def test_split_at(M, L):
+    for cut in [-1, 0, 1, 37, 100, 101, 150, 299, 300, 301]:
+        btree = build_tree(M, L, range(300), seed=cut + 5)
+        blocks = len(DISK.memory)
+        left, right = btree.split_at(cut)
+        assert left is btree
+        check_tree(left, range(0, max(min(cut, 300), 0)))
+        check_tree(right, range(max(min(cut, 300), 0), 300))
+        assert len(DISK.memory) - blocks < 20 # leaves are reused, not copied
+
+def test_split_at_then_join():
+    btree = build_tree(4, 4, range(500), seed=9)
+    left, right = btree.split_at(123)
+    check_tree(BTree.join(left, right), range(500))
+
+@pytest.mark.parametrize("M,L", [(3, 3), (4, 2), (5, 3), (6, 6)])
+@pytest.mark.parametrize("lo,hi", [(0, 300), (-5, 10), (100, 200), (150, 151), (290, 400), (50, 50), (200, 100)])
+def test_delete_range(M, L, lo, hi):
+    btree = build_tree(M, L, range(300), seed=lo)
+    pages_before = sum(len(level) for level in btree.levels())
+    free_before, blocks_before = len(DISK.free_blocks), len(DISK.memory)
+    btree.delete_range(lo, hi)
+    check_tree(btree, [k for k in range(300) if not lo <= k < hi])
+    pages_after = sum(len(level) for level in btree.levels())
+    # Every block the tree gave up went back to the free list, none leaked
+    freed = len(DISK.free_blocks) - free_before - (len(DISK.memory) - blocks_before)
+    assert freed == pages_before - pages_after
+
+def test_delete_range_within_leaf():
+    btree = build_tree(8, 8, range(1000), seed=10)
+    addrs = [node.my_addr for level in btree.levels() for node in level]
+    blocks, free = len(DISK.memory), len(DISK.free_blocks)
+    btree.delete_range(500, 503)
+    # The boundary leaf was trimmed in place, nothing was cut or reallocated
+    assert [node.my_addr for level in btree.levels() for node in level] == addrs
+    assert (len(DISK.memory), len(DISK.free_blocks)) == (blocks, free)
+    check_tree(btree, [k for k in range(1000) if not 500 <= k < 503])
+
+def test_delete_range_reuses_blocks():
+    btree = build_tree(4, 4, range(1000), seed=4)
+    btree.delete_range(100, 900)
+    blocks = len(DISK.memory)
+    other = build_tree(4, 4, range(300))
+    assert len(DISK.memory) == blocks # the new tree fits in the freed blocks
+    check_tree(btree, list(range(100)) + list(range(900, 1000)))
+    check_tree(other, range(300))
+
+def test_double_free():
+    addr = DISK.new()
+    DISK.free(addr)
+    with pytest.raises(ValueError):
+        DISK.free(addr)
+    assert DISK.free_blocks.count(addr) == 1
+    assert DISK.new() == addr
+    DISK.free(addr) # allocated again, so it can be freed again
+
+def test_clear():
+    btree = build_tree(5, 3, range(200), seed=6)
+    root_addr = btree.root_addr
+    btree.clear()
+    assert btree.root_addr == root_addr
+    check_tree(btree, [])
+    assert btree.find(5) is None
+    btree.insert(5, "5")
+    assert btree.find(5) == "5"